@@ -31,6 +31,9 @@ ABSOLUTE_MAX_REFUSALS = const(100)
 # mode, if you enable the boot_to_hsm feature
 BOOT_LOCKOUT_TIME = const(60)
 
+# warm-up ujson once, makes the first (boot-time) policy parse faster
+ujson.dumps(None)
+
 def hsm_policy_available():
     # Is there an HSM policy ready to go? Offer the menu item then.
     try:
@@ -55,10 +58,11 @@ def restore_backup(s):
     assert s[0] == '{'
     assert s[-1] == '}'
     try:
-        ujson.loads(s)
+        j = ujson.loads(s)
 
+        # store minified, since backup might be pretty-printed; faster to load
         with open(POLICY_FNAME, 'wt') as f:
-            f.write(s)
+            ujson.dump(j, f)
     except BaseException as exc:
         # keep going, we don't want to brick
         sys.print_exception(exc)
@@ -95,11 +99,11 @@ def pop_int(j, fld_name, mn=0, mx=1000):
     # returns an int or None. Also range check.
     v = j.pop(fld_name, None)
     if v is None: return v
-    assert int(v) == v, "%s: must be integer" % fld_name
-    v = int(v)
+    iv = int(v)
+    assert iv == v, "%s: must be integer" % fld_name
     assert mn <= mx, '%s: cannot be specified' % fld_name
-    assert mn <= v <= mx, "%s: must be in range: [%d..%d]" % (fld_name, mn, mx)
-    return v
+    assert mn <= iv <= mx, "%s: must be in range: [%d..%d]" % (fld_name, mn, mx)
+    return iv
 
 def pop_bool(j, fld_name, default=False):
     # return a bool, but accept 1/0 and True/False
@@ -121,15 +125,17 @@ def cleanup_whitelist_value(s):
     # one element in a list of addresses or paths or descriptors?
     # - later matching is string-based, so just doing basic syntax check here
     # - must be checksumed-base58 or bech32
-    try:
-        ngu.codecs.b58_decode(s)
-        return s
-    except: pass
+    # - try likely decoder first (by prefix), so valid values don't raise
+    if s[0:3].lower() in ('bc1', 'tb1', 'bcr'):
+        decoders = (ngu.codecs.segwit_decode, ngu.codecs.b58_decode)
+    else:
+        decoders = (ngu.codecs.b58_decode, ngu.codecs.segwit_decode)
 
-    try:
-        ngu.codecs.segwit_decode(s)
-        return s
-    except: pass
+    for dec in decoders:
+        try:
+            dec(s)
+            return s
+        except: pass
 
     raise ValueError('bad whitelist value: ' + s)
 
@@ -143,8 +149,9 @@ class ApprovalRule:
     # - local_conf: local user must also confirm w/ code
     # - wallet: which multisig wallet to restrict to, or '1' for single signer only
 
-    def __init__(self, j, idx):
+    def __init__(self, j, idx, ms_names=None):
         # read json dict provided
+        # - ms_names: names of multisig wallets, if caller already has them
         self.spent_so_far = 0       # for velocity
 
         def check_user(u):
@@ -161,7 +168,11 @@ class ApprovalRule:
         self.local_conf = pop_bool(j, 'local_conf')
         self.wallet = pop_string(j, 'wallet', 1, 20)
 
-        assert sorted(set(self.users)) == sorted(self.users), 'dup users'
+        # fixed after load, so build lookup sets just once
+        self._wl_set = frozenset(self.whitelist)
+        self._users_set = frozenset(self.users)
+
+        assert len(self._users_set) == len(self.users), 'dup users'
 
         # usernames need to be correct and already known
         if self.min_users is None:
@@ -172,8 +183,9 @@ class ApprovalRule:
 
         # if specified, 'wallet' must be an existing multisig wallet's name
         if self.wallet and self.wallet != '1':
-            names = [ms.name for ms in MultisigWallet.get_all()]
-            assert self.wallet in names, "unknown MS wallet: "+self.wallet
+            if ms_names is None:
+                ms_names = [ms.name for ms in MultisigWallet.get_all()]
+            assert self.wallet in ms_names, "unknown MS wallet: "+self.wallet
 
         assert_empty_dict(j)
 
@@ -234,6 +246,10 @@ class ApprovalRule:
 
     def matches_transaction(self, psbt, users, total_out, dests, local_oked):
         # Does this rule apply to this PSBT file? 
+        # - all must pass, so cheapest checks go first
+        if self.max_amount is not None:
+            assert total_out <= self.max_amount, 'amount exceeded'
+
         if self.wallet:
             # rule limited to one wallet
             if psbt.active_multisig:
@@ -243,33 +259,33 @@ class ApprovalRule:
                 # non multisig, but does this rule apply to all wallets or single-singers
                 assert self.wallet == '1', 'not multisig'
 
-        if self.max_amount is not None:
-            assert total_out <= self.max_amount, 'amount exceeded'
-
-        # check all destinations are in the whitelist
-        if self.whitelist:
-            diff = set(dests) - set(self.whitelist)
-            assert not diff, "non-whitelisted address: " + diff.pop()
-
         if self.local_conf:
             # local user must approve
             assert local_oked, "local operator didn't confirm"
 
+        if self.per_period is not None:
+            # check this txn would not exceed the velocity limit
+            assert self.spent_so_far + total_out <= self.per_period, 'would exceed period spending'
+
         if self.users:
             # some remote users need to approve
-            given = set(self.users).intersection(users)
+            given = self._users_set.intersection(users)
             assert given, 'need user(s) confirmation'
             assert len(given) >= self.min_users, 'need more users to confirm (got %d of %d)'%(
                                         len(given), self.min_users)
 
-        if self.per_period is not None:
-            # check this txn would not exceed the velocity limit
-            assert self.spent_so_far + total_out <= self.per_period, 'would exceed period spending'
+        # check all destinations are in the whitelist
+        if self.whitelist:
+            # - stop at first address that isn't listed
+            wl = self._wl_set
+            for d in dests:
+                assert d in wl, "non-whitelisted address: " + d
 
         return True
 
 class AuditLogger:
     def __init__(self, dirname, digest, never_log):
+        # digest: hex string of SHA256 over thing being logged
         self.dirname = dirname
         self.digest = digest
         self.never_log = never_log
@@ -287,7 +303,7 @@ class AuditLogger:
             try: uos.stat(d)
             except: uos.mkdir(d)
                 
-            self.fname = d + '/' + b2a_hex(self.digest[-8:]).decode('ascii') + '.log'
+            self.fname = d + '/' + self.digest[-16:] + '.log'
             self.fd = open(self.fname, 'a+t')       # append mode
         except (CardMissingError, OSError, NotImplementedError):
             # may be fatal or not, depending on configuration
@@ -327,6 +343,7 @@ class HSMPolicy:
         self.sl_reads = 0
         self.pending_auth = {}
         self.start_time = 0
+        self.last_refusal = None
 
         # velocity limits
         self.period_started = 0
@@ -356,11 +373,26 @@ class HSMPolicy:
         self.share_xpubs = pop_deriv_list(j, 'share_xpubs')
         self.share_addrs = pop_deriv_list(j, 'share_addrs', 'p2sh')
 
+        # precompute for quick checks on each USB request
+        self._msg_paths_set = frozenset(self.msg_paths)
+        self._msg_any = 'any' in self._msg_paths_set
+        self._share_xpubs_set = frozenset(self.share_xpubs)
+        self._xpubs_any = 'any' in self._share_xpubs_set
+        self._share_addrs_set = frozenset(self.share_addrs)
+        self._addrs_any = 'any' in self._share_addrs_set
+        self._share_addrs_p2sh = 'p2sh' in self._share_addrs_set
+
+        # only wildcard patterns need the slower match_deriv_path() check
+        self._msg_wild = [p for p in self.msg_paths if '*' in p]
+        self._xpubs_wild = [p for p in self.share_xpubs if '*' in p]
+        self._addrs_wild = [p for p in self.share_addrs if '*' in p]
+
         # free text shown at top
         self.notes = pop_string(j, 'notes', 1, 80)
 
         # time period, in minutes
         self.period = pop_int(j, 'period', 1, 3*24*60)
+        self._period_secs = (self.period or 0) * 60
 
         # how many times they may view the long-secret
         self.allow_sl = pop_int(j, 'allow_sl', 1, 100)
@@ -374,7 +406,10 @@ class HSMPolicy:
 
         # complex txn approval rules
         lst = pop_list(j, 'rules') or []
-        self.rules = [ApprovalRule(i, idx) for idx, i in enumerate(lst)]
+        ms_names = None
+        if any(r.get('wallet') not in (None, '1') for r in lst):
+            ms_names = frozenset(ms.name for ms in MultisigWallet.get_all())
+        self.rules = [ApprovalRule(i, idx, ms_names) for idx, i in enumerate(lst)]
 
         if not self.period and any(i.has_velocity for i in self.rules):
             raise ValueError("Needs period to be specified")
@@ -426,13 +461,20 @@ class HSMPolicy:
                 fd.write('\n = %.3g hrs' % (self.period / 60))
             fd.write('\n')
 
-        def plist(pl):
+        def plist_to(fd, pl):
+            # write directly into fd, rather than building up a string
             remap = {'any': '(any path)', 'p2sh': '(any P2SH)' }
-            return ' OR '.join(remap.get(i, i) for i in pl)
+            sep = ''
+            for i in pl:
+                fd.write(sep)
+                fd.write(remap.get(i, i))
+                sep = ' OR '
 
         fd.write('\nMessage signing:\n')
         if self.msg_paths:
-            fd.write("- Allowed if path matches: %s\n" % plist(self.msg_paths))
+            fd.write("- Allowed if path matches: ")
+            plist_to(fd, self.msg_paths)
+            fd.write("\n")
         else:
             fd.write("- Not allowed.\n")
 
@@ -454,11 +496,13 @@ class HSMPolicy:
             fd.write('- PSBT warnings will be ignored.\n')
 
         if self.share_xpubs:
-            fd.write('- XPUB values will be shared, if path matches: m OR %s.\n' 
-                                % plist(self.share_xpubs))
+            fd.write('- XPUB values will be shared, if path matches: m OR ')
+            plist_to(fd, self.share_xpubs)
+            fd.write('.\n')
         if self.share_addrs:
-            fd.write('- Address values values will be shared, if path matches: %s.\n' 
-                                % plist(self.share_addrs))
+            fd.write('- Address values values will be shared, if path matches: ')
+            plist_to(fd, self.share_addrs)
+            fd.write('.\n')
         if self.priv_over_ux:
             fd.write('- Status responses optimized for privacy.\n')
         if self.boot_to_hsm:
@@ -477,8 +521,12 @@ class HSMPolicy:
 
         if not self.priv_over_ux:
             # Add some values we will share over USB during HSM operation
-            for fn in ['summary', 'last_refusal', 'approvals', 'refusals', 'sl_reads', 'period']:
-                rv[fn] = getattr(self, fn, None)
+            rv['summary'] = getattr(self, 'summary', None)
+            rv['period'] = self.period
+            rv['last_refusal'] = self.last_refusal
+            rv['approvals'] = self.approvals
+            rv['refusals'] = self.refusals
+            rv['sl_reads'] = self.sl_reads
 
             rv['uptime'] = self.uptime
 
@@ -494,8 +542,9 @@ class HSMPolicy:
             rv['pending_auth'] = len(self.pending_auth)
         else:
             # share much less... they will need to know the policy in place
-            for fn in ['last_refusal', 'approvals', 'refusals']:
-                rv[fn] = getattr(self, fn, None)
+            rv['last_refusal'] = self.last_refusal
+            rv['approvals'] = self.approvals
+            rv['refusals'] = self.refusals
 
     def activate(self, new_file):
         # user approved the HSM activation, so apply it.
@@ -557,8 +606,7 @@ class HSMPolicy:
             # they haven't spent anything yet (in period)
             return -1
 
-        so_far = (utime.ticks_ms() // 1000) - self.period_started
-        left = (self.period*60) - so_far
+        left = (self.period_started + self._period_secs) - (utime.ticks_ms() // 1000)
         if left <= 0:
             # period is over, reset totals
             self.reset_period()
@@ -574,16 +622,17 @@ class HSMPolicy:
         from pincodes import pa
 
         # add length half-word to start, and pad to max size
+        # - 's' format zero-fills the remainder, all in one pass
         tmp = bytearray(AE_LONG_SECRET_LEN)
         val = self.set_sl.encode('utf8')
-        ustruct.pack_into('H', tmp, 0, len(val))
-        tmp[2:2+len(self.set_sl)] = val
+        assert len(val) <= AE_LONG_SECRET_LEN-2     # 's' pack would truncate
+        ustruct.pack_into('H%ds' % (AE_LONG_SECRET_LEN-2), tmp, 0, len(val), val)
 
         # write it
         pa.ls_change(tmp)
 
-        # memory cleanup
-        blank_object(tmp)
+        # memory cleanup: we own tmp, so can wipe it in C rather than byte-by-byte
+        ustruct.pack_into('%ds' % AE_LONG_SECRET_LEN, tmp, 0, b'')
         blank_object(val)
         blank_object(self.set_sl)
         self.set_sl = None
@@ -617,15 +666,15 @@ class HSMPolicy:
     async def approve_msg_sign(self, msg_text, address, subpath):
         # Maybe approve indicated message to be signed.
         # return 'y' or 'x'
-        sha = ngu.hash.sha256s(msg_text)
-        with AuditLogger('messages', sha, self.never_log) as log:
+        sha_hex = b2a_hex(ngu.hash.sha256s(msg_text)).decode('ascii')
+        with AuditLogger('messages', sha_hex, self.never_log) as log:
 
             if self.must_log and log.is_unsaved:
                 self.refuse(log, "Could not log details, and must_log is set")
                 return 'x'
 
             log.info('Message signing requested:')
-            log.info('SHA256(msg) = ' + b2a_hex(sha).decode('ascii'))
+            log.info('SHA256(msg) = ' + sha_hex)
             log.info('\n%d bytes to be signed by %s => %s' 
                             % (len(msg_text), subpath, address))
 
@@ -633,7 +682,8 @@ class HSMPolicy:
                 self.refuse(log, "Message signing not permitted")
                 return 'x'
 
-            if not match_deriv_path(self.msg_paths, subpath):
+            if not (self._msg_any or subpath in self._msg_paths_set
+                        or (self._msg_wild and match_deriv_path(self._msg_wild, subpath))):
                 self.refuse(log, 'Message signing not enabled for that path')
                 return 'x'
 
@@ -651,7 +701,11 @@ class HSMPolicy:
         if not self.share_xpubs:
             return False
 
-        return match_deriv_path(self.share_xpubs, subpath)
+        if self._xpubs_any or subpath in self._share_xpubs_set:
+            return True
+
+        # maybe a wildcard pattern
+        return bool(self._xpubs_wild) and match_deriv_path(self._xpubs_wild, subpath)
 
     def approve_address_share(self, subpath=None, is_p2sh=False):
         # Are we allowing "show address" requests over USB?
@@ -660,9 +714,13 @@ class HSMPolicy:
             return False
 
         if is_p2sh:
-            return ('p2sh' in self.share_addrs)
+            return self._share_addrs_p2sh
+
+        if self._addrs_any or subpath in self._share_addrs_set:
+            return True
 
-        return match_deriv_path(self.share_addrs, subpath)
+        # maybe a wildcard pattern
+        return bool(self._addrs_wild) and match_deriv_path(self._addrs_wild, subpath)
 
     @property
     def uptime(self):
@@ -708,16 +766,20 @@ class HSMPolicy:
         # - return 'y' or 'x'
         chain = chains.current_chain()
         assert psbt_sha and len(psbt_sha) == 32
+        auth_okay = Users.auth_okay
+        render_address = chain.render_address
         self.get_time_left()
 
-        with AuditLogger('psbt', psbt_sha, self.never_log) as log:
+        sha_hex = b2a_hex(psbt_sha).decode('ascii')
+
+        with AuditLogger('psbt', sha_hex, self.never_log) as log:
 
             if self.must_log and log.is_unsaved:
                 self.refuse(log, "Could not log details, and must_log is set")
                 return 'x'
 
             log.info('Transaction signing requested:')
-            log.info('SHA256(PSBT) = ' + b2a_hex(psbt_sha).decode('ascii'))
+            log.info('SHA256(PSBT) = ' + sha_hex)
             log.info('-vvv-\n%s\n-^^^-' % story)
 
             # reset pending auth list and "consume" it now
@@ -741,7 +803,7 @@ class HSMPolicy:
                 # See who has entered creditials already (all must be valid).
                 users = []
                 for u, (token, counter) in auth.items():
-                    problem = Users.auth_okay(u, token, totp_time=counter, psbt_hash=psbt_sha)
+                    problem = auth_okay(u, token, totp_time=counter, psbt_hash=psbt_sha)
                     if problem:
                         self.refuse(log, "User '%s' gave wrong auth value: %s" % (u, problem))
                         return 'x'
@@ -754,12 +816,15 @@ class HSMPolicy:
                     log.info("These users gave correct auth codes: " + ', '.join(users))
 
                 # Where is it going?
+                # - only need to render addresses if some rule checks them
+                needs_dests = any(r.whitelist for r in self.rules)
                 total_out = 0
                 dests = []
                 for idx, tx_out in psbt.output_iter():
                     if not psbt.outputs[idx].is_change:
                         total_out += tx_out.nValue
-                        dests.append(chain.render_address(tx_out.scriptPubKey))
+                        if needs_dests:
+                            dests.append(render_address(tx_out.scriptPubKey))
 
                 # Pick a rule to apply to this specific txn
                 reasons = []
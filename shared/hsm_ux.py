@@ -100,7 +100,8 @@ async def start_hsm_approval(sf_len=0, usb_mode=False, startup_mode=False):
             json = fd.read(sf_len).decode()
     else:
         try:
-            json = open(POLICY_FNAME, 'rt').read()
+            # parsed directly from file below, to avoid a copy of the text
+            uos.stat(POLICY_FNAME)
         except:
             raise ValueError("No existing policy")
 
@@ -110,7 +111,11 @@ async def start_hsm_approval(sf_len=0, usb_mode=False, startup_mode=False):
     cant_fail = False
     try:
         try:
-            js_policy = ujson.loads(json)
+            if is_new:
+                js_policy = ujson.loads(json)
+            else:
+                with open(POLICY_FNAME, 'rt') as fd:
+                    js_policy = ujson.load(fd)
         except:
             raise ValueError("JSON parse fail")
 
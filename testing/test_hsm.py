@@ -978,6 +978,26 @@ def test_user_subset(dev, start_hsm, tweak_rule, load_hsm_users, fake_txn, attem
             auth_user(name, do_replay=True)
             attempt_psbt(psbt, 'replay' if name == 'totp' else 'mismatch')
 
+def test_user_not_in_policy(dev, start_hsm, load_hsm_users, fake_txn, attempt_psbt, auth_user):
+    # auth from known users that no rule mentions is still checked
+    psbt = fake_txn(1,1, dev.master_xpub)
+    auth_user.psbt_hash = sha256(psbt).digest()
+
+    policy = DICT(rules=[dict(users=['totp'])])
+    load_hsm_users()
+    start_hsm(policy)
+
+    # valid auth from other user doesn't help
+    auth_user('pw')
+    attempt_psbt(psbt, 'need user(s) confirmation')
+
+    # .. and bad auth from them still refuses
+    auth_user('totp')
+    auth_user('pw', garbage=True)
+    msg = attempt_psbt(psbt, ': mismatch')
+    assert 'pw' in msg
+    assert 'wrong auth' in msg
+
 def test_min_users_parse(dev, start_hsm, tweak_rule, load_hsm_users, 
                             auth_user, sim_exec, readback_rule):
 